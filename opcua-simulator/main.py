@@ -6,13 +6,18 @@ Simple simulator that:
 - Listens for stop_order -> stops simulation
 """
 
+import array
 import asyncio
-import json
 import logging
 import os
+import random
+import socket
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
 
+import aiomqtt
+import orjson
+import uvloop
 from asyncua import Server, ua
 from asyncua.common.node import Node
 
@@ -28,22 +33,149 @@ MQTT_BROKER = os.getenv("MQTT_BROKER", "emqx")
 MQTT_PORT = int(os.getenv("MQTT_PORT", "1883"))
 OPCUA_PORT = int(os.getenv("OPCUA_PORT", "4840"))
 SIMULATION_INTERVAL = int(os.getenv("SIMULATION_INTERVAL", "5"))
+MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", "30"))
+
+# MQTT command topics
+_START_TOPIC = "menen/sort3/start_order"
+_STOP_TOPIC = "menen/sort3/stop_order"
+
+# Reconnect backoff: doubles from 1s up to 30s, plus up to 1s of random jitter
+_MQTT_BACKOFF_INITIAL = 1.0
+_MQTT_BACKOFF_MAX = 30.0
+
+# Disable Nagle and enlarge the kernel socket buffers (2 MiB, still capped by
+# net.core.rmem_max/wmem_max). aiomqtt applies these only after connect(), so
+# the TCP window scale is already negotiated; the larger buffers give some
+# extra headroom for bursts but do not guarantee that none are dropped
+_MQTT_SOCKET_OPTIONS = (
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_RCVBUF, 2 * 1024 * 1024),
+    (socket.SOL_SOCKET, socket.SO_SNDBUF, 2 * 1024 * 1024),
+)
+
+# Private RNG for box selection
+_rand = random.Random()
+
+# Zero-padded box numbers used in LPN IDs, indexed by box - 1
+_BOX_SUFFIX = tuple(f"{i:03d}" for i in range(1, 7))
+
+
+def _first_present(d: Dict, *keys: str, default: Any, cast: Callable[[Any], Any]) -> Any:
+    """Return cast(d[key]) for the first key present (and not null) in d, else default."""
+    for key in keys:
+        if key in d and d[key] is not None:
+            return cast(d[key])
+    return default
 
 
 class Sort3Simulator:
     """SORT3 PLC Simulator with OPC UA server and MQTT integration."""
 
+    # Accepted start_order payload keys per setting, in order of precedence
+    # (several names are supported for backwards-compatibility)
+    _ALIASES = {
+        "po_id": ("production_order", "po_id"),
+        "po_qty": ("quantity", "po_qty"),
+        "speedbelt": ("belt_speed", "speedbelt", "SRT_SPEEDBELTTRANSPORT"),
+        "max_sheets": ("max_sheets", "maxSheets", "max_sheets_box", "SRT_MAXSHEETSBOX"),
+        "open_distance": ("open_distance", "openDistance", "SRT_OPENBOXDISTNACE"),
+    }
+
+    # OPC UA variant type of every tag
+    _VARIANT_TYPES: Dict[str, ua.VariantType] = {
+        # STARTED_PO
+        "SRT_OBJT_NEW_VALUE": ua.VariantType.Boolean,
+        "SRT_PLC_VALUE_PROCESSED": ua.VariantType.Boolean,
+        "SRT_PO_ID": ua.VariantType.String,
+        "SRT_PO_QTY": ua.VariantType.Int32,
+        "SRT3_IN2": ua.VariantType.String,
+        "ORDER_STATUS": ua.VariantType.Int32,
+        
+        # CUSTOM_ATTRIBUTES
+        "SRT_SPEEDBELTTRANSPORT": ua.VariantType.Double,
+        "SRT_MAXSHEETSBOX": ua.VariantType.Double,
+        "SRT_OPENBOXDISTNACE": ua.VariantType.Double,
+        
+        # SORT stations 1-6
+        **{f"SRT_{i}_ACTIVE": ua.VariantType.Boolean for i in range(1, 7)},
+        **{f"SRT_{i}_CUTTING": ua.VariantType.Boolean for i in range(1, 7)},
+        **{f"SRT_{i}_ITEMNAME": ua.VariantType.String for i in range(1, 7)},
+        **{f"SRT_{i}_TAPE": ua.VariantType.Boolean for i in range(1, 7)},
+        **{f"SRT_{i}_VENEER_L": ua.VariantType.Double for i in range(1, 7)},
+        **{f"SRT_{i}_QTY": ua.VariantType.Int32 for i in range(1, 7)},
+        
+        # BLOCK_OUTPUT
+        "BB_BOX_BLOCK": ua.VariantType.Boolean,
+        "BB_CUTTING": ua.VariantType.Boolean,
+        "BB_ITEMNAME": ua.VariantType.String,
+        "BB_OBJT_NEW_VALUE": ua.VariantType.Boolean,
+        "BB_OUT_BOXNR": ua.VariantType.Int32,
+        "BB_PLC_VALUE_PROCESSED": ua.VariantType.Boolean,
+        "BB_TAPE": ua.VariantType.Boolean,
+        "BB_VENEER_L": ua.VariantType.Double,
+        
+        # VENEER_STACKED
+        "OUT_BOXFULL": ua.VariantType.Boolean,
+        "OUT_BOXNR": ua.VariantType.Int32,
+        "OUT_LPN_ID": ua.VariantType.String,
+        "OUT_LPN_QTY": ua.VariantType.Int32,
+        "OUT_OBJT_VALUE_PROCESSED": ua.VariantType.Boolean,
+        "OUT_PLC_NEW_VALUE": ua.VariantType.Boolean,
+        "OUT_REPAIR": ua.VariantType.Boolean,
+        "OUT_PO_ID": ua.VariantType.String,
+    }
+
+    # Python conversion applied to a value before it is written as each variant type
+    _CAST: Dict[ua.VariantType, Callable[[Any], Any]] = {
+        ua.VariantType.Boolean: bool,
+        ua.VariantType.Int32: int,
+        ua.VariantType.Double: float,
+        ua.VariantType.String: str,
+    }
+
+    __slots__ = (
+        "server", "running", "order_active", "current_order", "_lpn_prefix", "_dbg",
+        "nodes", "_node_writers", "_write_buffer", "_pulse_tasks", "box_quantities",
+        "station_active", "station_cutting", "station_itemname", "station_tape",
+        "station_veneer_l", "station_qty", "_station_writers", "_active_indices", "state",
+        "_write_out_boxnr", "_write_out_lpn_qty", "_write_out_lpn_id",
+        "_write_out_plc_new_value", "_write_out_boxfull",
+    )
+
     def __init__(self):
         self.server: Optional[Server] = None
         self.running = False
         self.order_active = False
         self.current_order = ""
+        self._lpn_prefix = ""
+        # Checked once; the node writers run for every staged tag write
+        self._dbg = logger.isEnabledFor(logging.DEBUG)
         
         # OPC UA node references
         self.nodes: Dict[str, Node] = {}
-        
-        # Track quantities for each of the 6 boxes
-        self.box_quantities = {i: 0 for i in range(1, 7)}
+        # Per-tag writers that convert and stage a value (built at node creation)
+        self._node_writers: Dict[str, Callable[[Any], Any]] = {}
+        
+        # Pending (NodeId, Variant) writes, sent to the server in one call by flush_updates()
+        self._write_buffer: List[Tuple[ua.NodeId, ua.Variant]] = []
+        
+        # Delayed tag resets (pulses) scheduled by the simulation tick
+        self._pulse_tasks: Set[asyncio.Task] = set()
+        
+        # Track quantities for each of the 6 boxes, indexed by box - 1
+        self.box_quantities = array.array("i", [0] * 6)
+        
+        # SORT stations 1-6, one list per tag indexed by station - 1
+        self.station_active: List[bool] = [False] * 6
+        self.station_cutting: List[bool] = [False] * 6
+        self.station_itemname: List[str] = [""] * 6
+        self.station_tape: List[bool] = [False] * 6
+        self.station_veneer_l: List[float] = [0.0] * 6
+        self.station_qty: List[int] = [0] * 6
+        # Node writers per station, keyed by tag suffix ("ACTIVE", "QTY", ...)
+        self._station_writers: List[Dict[str, Callable[[Any], Any]]] = [{} for _ in range(6)]
+        # Indices of the active stations, picked from by the simulation tick
+        self._active_indices = array.array("B")
         
         # Current state
         self.state = {
@@ -60,14 +192,6 @@ class Sort3Simulator:
             "SRT_MAXSHEETSBOX": 0.0,
             "SRT_OPENBOXDISTNACE": 0.0,
             
-            # SORT stations 1-6
-            **{f"SRT_{i}_ACTIVE": False for i in range(1, 7)},
-            **{f"SRT_{i}_CUTTING": False for i in range(1, 7)},
-            **{f"SRT_{i}_ITEMNAME": "" for i in range(1, 7)},
-            **{f"SRT_{i}_TAPE": False for i in range(1, 7)},
-            **{f"SRT_{i}_VENEER_L": 0.0 for i in range(1, 7)},
-            **{f"SRT_{i}_QTY": 0 for i in range(1, 7)},
-            
             # BLOCK_OUTPUT
             "BB_BOX_BLOCK": False,
             "BB_CUTTING": False,
@@ -119,157 +243,237 @@ class Sort3Simulator:
         veneer_stacked = await sort3_main.add_object(idx, "VENEER_STACKED")
         await self._create_veneer_stacked_nodes(idx, veneer_stacked)
         
+        # VENEER_STACKED tags are written every tick; keep their writers at hand
+        self._write_out_boxnr = self._node_writers["OUT_BOXNR"]
+        self._write_out_lpn_qty = self._node_writers["OUT_LPN_QTY"]
+        self._write_out_lpn_id = self._node_writers["OUT_LPN_ID"]
+        self._write_out_plc_new_value = self._node_writers["OUT_PLC_NEW_VALUE"]
+        self._write_out_boxfull = self._node_writers["OUT_BOXFULL"]
+        
         logger.info("OPC UA server initialized with all SORT3 tags")
 
-    async def _create_node_with_string_id(self, idx: int, parent: Node, name: str, var_type, default):
-        """Create a variable node with an explicit string-based NodeId."""
-        nodeid = ua.NodeId(name, idx)
-        node = await parent.add_variable(nodeid, name, default, var_type)
-        await node.set_writable()
-        self.nodes[name] = node
-        return node
+    async def _create_nodes_with_string_ids(self, idx: int, parent: Node, nodes_config):
+        """Create writable variable nodes with explicit string-based NodeIds in one add_nodes call.
+        
+        nodes_config rows are (name, default); the type comes from _VARIANT_TYPES.
+        """
+        items = []
+        for name, default in nodes_config:
+            var_type = self._VARIANT_TYPES[name]
+            attrs = ua.VariableAttributes()
+            attrs.Description = ua.LocalizedText(name)
+            attrs.DisplayName = ua.LocalizedText(name)
+            attrs.DataType = ua.NodeId(getattr(ua.ObjectIds, var_type.name))
+            attrs.Value = ua.Variant(default, var_type)
+            attrs.ValueRank = ua.ValueRank.Scalar
+            attrs.WriteMask = 0
+            attrs.UserWriteMask = 0
+            attrs.Historizing = False
+            attrs.AccessLevel = ua.AccessLevel.CurrentRead.mask | ua.AccessLevel.CurrentWrite.mask
+            attrs.UserAccessLevel = ua.AccessLevel.CurrentRead.mask | ua.AccessLevel.CurrentWrite.mask
+            
+            item = ua.AddNodesItem()
+            item.RequestedNewNodeId = ua.NodeId(name, idx)
+            item.BrowseName = ua.QualifiedName(name)
+            item.NodeClass = ua.NodeClass.Variable
+            item.ParentNodeId = parent.nodeid
+            item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasComponent)
+            item.TypeDefinition = ua.NodeId(ua.ObjectIds.BaseDataVariableType)
+            item.NodeAttributes = attrs
+            items.append(item)
+        
+        isession = self.server.iserver.isession
+        results = await isession.add_nodes(items)
+        for (name, _), result in zip(nodes_config, results):
+            result.StatusCode.check()
+            self.nodes[name] = Node(isession, result.AddedNodeId)
+            self._node_writers[name] = self._make_node_writer(name, result.AddedNodeId, self._VARIANT_TYPES[name])
+
+    def _make_node_writer(self, name: str, nodeid: ua.NodeId, var_type: ua.VariantType) -> Callable[[Any], Any]:
+        """Build a writer that casts a value to the node's type and stages it for the next flush."""
+        cast = self._CAST[var_type]
+
+        def writer(value: Any) -> Any:
+            value = cast(value)
+            self._write_buffer.append((nodeid, ua.Variant(value, var_type)))
+            # Logged here so writes that bypass update_node are traced too
+            if self._dbg:
+                logger.debug("Updated %s = %s", name, value)
+            return value
+
+        return writer
 
     async def _create_started_po_nodes(self, idx: int, parent: Node):
         nodes_config = [
-            ("SRT_OBJT_NEW_VALUE", ua.VariantType.Boolean, False),
-            ("SRT_PLC_VALUE_PROCESSED", ua.VariantType.Boolean, False),
-            ("SRT_PO_ID", ua.VariantType.String, ""),
-            ("SRT_PO_QTY", ua.VariantType.Int32, 0),
-            ("SRT3_IN2", ua.VariantType.String, ""),
-            ("ORDER_STATUS", ua.VariantType.Int32, 0),  # 1=active, 0=stopped
+            ("SRT_OBJT_NEW_VALUE", False),
+            ("SRT_PLC_VALUE_PROCESSED", False),
+            ("SRT_PO_ID", ""),
+            ("SRT_PO_QTY", 0),
+            ("SRT3_IN2", ""),
+            ("ORDER_STATUS", 0),  # 1=active, 0=stopped
         ]
-        for name, var_type, default in nodes_config:
-            await self._create_node_with_string_id(idx, parent, name, var_type, default)
+        await self._create_nodes_with_string_ids(idx, parent, nodes_config)
 
     async def _create_custom_attributes_nodes(self, idx: int, parent: Node):
         nodes_config = [
-            ("SRT_SPEEDBELTTRANSPORT", ua.VariantType.Double, 0.0),
-            ("SRT_MAXSHEETSBOX", ua.VariantType.Double, 0.0),
-            ("SRT_OPENBOXDISTNACE", ua.VariantType.Double, 0.0),
+            ("SRT_SPEEDBELTTRANSPORT", 0.0),
+            ("SRT_MAXSHEETSBOX", 0.0),
+            ("SRT_OPENBOXDISTNACE", 0.0),
         ]
-        for name, var_type, default in nodes_config:
-            await self._create_node_with_string_id(idx, parent, name, var_type, default)
+        await self._create_nodes_with_string_ids(idx, parent, nodes_config)
 
     async def _create_srt_station_nodes(self, idx: int, parent: Node, station: int):
         nodes_config = [
-            (f"SRT_{station}_ACTIVE", ua.VariantType.Boolean, False),
-            (f"SRT_{station}_CUTTING", ua.VariantType.Boolean, False),
-            (f"SRT_{station}_ITEMNAME", ua.VariantType.String, ""),
-            (f"SRT_{station}_TAPE", ua.VariantType.Boolean, False),
-            (f"SRT_{station}_VENEER_L", ua.VariantType.Double, 0.0),
-            (f"SRT_{station}_QTY", ua.VariantType.Int32, 0),  # Box quantity
+            ("ACTIVE", False),
+            ("CUTTING", False),
+            ("ITEMNAME", ""),
+            ("TAPE", False),
+            ("VENEER_L", 0.0),
+            ("QTY", 0),  # Box quantity
         ]
-        for name, var_type, default in nodes_config:
-            await self._create_node_with_string_id(idx, parent, name, var_type, default)
+        await self._create_nodes_with_string_ids(idx, parent, [
+            (f"SRT_{station}_{field}", default) for field, default in nodes_config
+        ])
+        self._station_writers[station - 1] = {
+            field: self._node_writers[f"SRT_{station}_{field}"] for field, _ in nodes_config
+        }
 
     async def _create_block_output_nodes(self, idx: int, parent: Node):
         nodes_config = [
-            ("BB_BOX_BLOCK", ua.VariantType.Boolean, False),
-            ("BB_CUTTING", ua.VariantType.Boolean, False),
-            ("BB_ITEMNAME", ua.VariantType.String, ""),
-            ("BB_OBJT_NEW_VALUE", ua.VariantType.Boolean, False),
-            ("BB_OUT_BOXNR", ua.VariantType.Int32, 0),
-            ("BB_PLC_VALUE_PROCESSED", ua.VariantType.Boolean, False),
-            ("BB_TAPE", ua.VariantType.Boolean, False),
-            ("BB_VENEER_L", ua.VariantType.Double, 0.0),
+            ("BB_BOX_BLOCK", False),
+            ("BB_CUTTING", False),
+            ("BB_ITEMNAME", ""),
+            ("BB_OBJT_NEW_VALUE", False),
+            ("BB_OUT_BOXNR", 0),
+            ("BB_PLC_VALUE_PROCESSED", False),
+            ("BB_TAPE", False),
+            ("BB_VENEER_L", 0.0),
         ]
-        for name, var_type, default in nodes_config:
-            await self._create_node_with_string_id(idx, parent, name, var_type, default)
+        await self._create_nodes_with_string_ids(idx, parent, nodes_config)
 
     async def _create_veneer_stacked_nodes(self, idx: int, parent: Node):
         nodes_config = [
-            ("OUT_BOXFULL", ua.VariantType.Boolean, False),
-            ("OUT_BOXNR", ua.VariantType.Int32, 1),
-            ("OUT_LPN_ID", ua.VariantType.String, ""),
-            ("OUT_LPN_QTY", ua.VariantType.Int32, 0),
-            ("OUT_OBJT_VALUE_PROCESSED", ua.VariantType.Boolean, False),
-            ("OUT_PLC_NEW_VALUE", ua.VariantType.Boolean, False),
-            ("OUT_REPAIR", ua.VariantType.Boolean, False),
-            ("OUT_PO_ID", ua.VariantType.String, ""),
+            ("OUT_BOXFULL", False),
+            ("OUT_BOXNR", 1),
+            ("OUT_LPN_ID", ""),
+            ("OUT_LPN_QTY", 0),
+            ("OUT_OBJT_VALUE_PROCESSED", False),
+            ("OUT_PLC_NEW_VALUE", False),
+            ("OUT_REPAIR", False),
+            ("OUT_PO_ID", ""),
         ]
-        for name, var_type, default in nodes_config:
-            await self._create_node_with_string_id(idx, parent, name, var_type, default)
-
-    async def update_node(self, name: str, value: Any):
-        """Update an OPC UA node value."""
-        if name in self.nodes:
-            try:
-                # Convert Python int to Int32 for OPC UA
-                if isinstance(value, int) and not isinstance(value, bool):
-                    value = ua.Int32(value)
-                await self.nodes[name].write_value(value)
-                self.state[name] = int(value) if isinstance(value, ua.Int32) else value
-                logger.debug(f"Updated {name} = {value}")
-            except Exception as e:
-                logger.error(f"Failed to update {name} with value {value} (type {type(value).__name__}): {e}")
+        await self._create_nodes_with_string_ids(idx, parent, nodes_config)
+
+    def update_node(self, name: str, value: Any):
+        """Stage an OPC UA node value; it is written on the next flush_updates()."""
+        self.state[name] = self._node_writers[name](value)
+
+    def update_station(self, i: int, active: bool, itemname: str, cutting: bool, tape: bool, veneer_l: float):
+        """Stage all SRT_<n>_* tags of station index i (0-based) and reset its box quantity."""
+        writers = self._station_writers[i]
+        self.station_active[i] = writers["ACTIVE"](active)
+        self.station_itemname[i] = writers["ITEMNAME"](itemname)
+        self.station_cutting[i] = writers["CUTTING"](cutting)
+        self.station_tape[i] = writers["TAPE"](tape)
+        self.station_veneer_l[i] = writers["VENEER_L"](veneer_l)
+        self.update_station_qty(i, 0)
+
+    def update_station_qty(self, i: int, qty: int):
+        """Stage the SRT_<n>_QTY tag of station index i (0-based)."""
+        self.station_qty[i] = self._station_writers[i]["QTY"](qty)
+
+    async def flush_updates(self):
+        """Write all staged node values to the OPC UA server in a single request."""
+        if not self._write_buffer:
+            return
+        # Swap the buffer first so values staged while we await go into the next flush
+        buffer, self._write_buffer = self._write_buffer, []
+        # All values in one flush share a single SourceTimestamp (asyncua still
+        # sets the ServerTimestamp itself on each write)
+        ts = datetime.utcnow()
+        params = ua.WriteParameters()
+        for nodeid, variant in buffer:
+            write_value = ua.WriteValue()
+            write_value.NodeId = nodeid
+            write_value.AttributeId = ua.AttributeIds.Value
+            write_value.Value = ua.DataValue(variant, SourceTimestamp=ts)
+            params.NodesToWrite.append(write_value)
+        try:
+            results = await self.server.iserver.isession.write(params)
+        except Exception as e:
+            logger.error(f"Failed to write {len(buffer)} node values: {e}")
+            return
+        for (nodeid, variant), status in zip(buffer, results):
+            if not status.is_good():
+                logger.error(f"Failed to update {nodeid.Identifier} with value {variant.Value}: {status}")
 
     async def handle_start_order(self, payload: Dict):
         """Handle start order command."""
         logger.info(f"Processing payload: {payload}")
         
-        # Support both 'production_order' and 'po_id' keys
-        po_id = payload.get("production_order") or payload.get("po_id")
-        po_qty = int(payload.get("quantity") or payload.get("po_qty") or 0)
+        # Take each setting from the first alias present in the payload, so an
+        # explicit 0 is kept instead of falling through to the next key
+        aliases = self._ALIASES
+        po_id = _first_present(payload, *aliases["po_id"], default="", cast=str)
+        po_qty = _first_present(payload, *aliases["po_qty"], default=0, cast=int)
         stations = payload.get("stations", []) or []
 
-        # Custom attributes: support multiple key names for backwards-compatibility
-        speedbelt = float(payload.get("belt_speed") or payload.get("speedbelt") or payload.get("SRT_SPEEDBELTTRANSPORT") or 0.0)
-        max_sheets = float(payload.get("max_sheets") or payload.get("maxSheets") or payload.get("max_sheets_box") or payload.get("SRT_MAXSHEETSBOX") or 0.0)
-        open_distance = float(payload.get("open_distance") or payload.get("openDistance") or payload.get("SRT_OPENBOXDISTNACE") or 0.0)
+        # Custom attributes
+        speedbelt = _first_present(payload, *aliases["speedbelt"], default=0.0, cast=float)
+        max_sheets = _first_present(payload, *aliases["max_sheets"], default=0.0, cast=float)
+        open_distance = _first_present(payload, *aliases["open_distance"], default=0.0, cast=float)
 
         logger.info(f"=== STARTING ORDER: {po_id} ===")
         
-        self.current_order = po_id
-        self.order_active = True
-
-        # Reset all box quantities
-        self.box_quantities = {i: 0 for i in range(1, 7)}
-        
-        # Update STARTED_PO tags
-        await self.update_node("SRT_PO_ID", po_id)
-        await self.update_node("SRT_PO_QTY", po_qty)
-        # Update custom attributes from payload
-        await self.update_node("SRT_SPEEDBELTTRANSPORT", speedbelt)
-        await self.update_node("SRT_MAXSHEETSBOX", max_sheets)
-        await self.update_node("SRT_OPENBOXDISTNACE", open_distance)
-        await self.update_node("SRT_OBJT_NEW_VALUE", True)
-        await self.update_node("ORDER_STATUS", 1)  # 1 = active
-        
-        # Initialize VENEER_STACKED
-        await self.update_node("OUT_PO_ID", po_id)
-        await self.update_node("OUT_LPN_QTY", 0)
-        await self.update_node("OUT_BOXNR", 1)
-        await self.update_node("OUT_BOXFULL", False)
-        await self.update_node("OUT_PLC_NEW_VALUE", False)
-        
-        # Initialize stations according to payload 'stations' list.
-        # If a station entry is missing or active is False, leave it deactivated and clear values.
-        for i in range(1, 7):
-            st = stations[i - 1] if len(stations) >= i and isinstance(stations[i - 1], dict) else {}
-            active = bool(st.get("active", False))
-
-            await self.update_node(f"SRT_{i}_ACTIVE", active)
-
-            if active:
-                # Set optional station properties when active
-                itemname = st.get(f"box{i}_material") or st.get("material") or ""
-                cutting = bool(st.get("cutting", False))
-                tape = bool(st.get("tape", False))
-                veneer_l = float(st.get("veneer_l", 0.0) or 0.0)
-
-                await self.update_node(f"SRT_{i}_ITEMNAME", str(itemname))
-                await self.update_node(f"SRT_{i}_CUTTING", cutting)
-                await self.update_node(f"SRT_{i}_TAPE", tape)
-                await self.update_node(f"SRT_{i}_VENEER_L", veneer_l)
-                await self.update_node(f"SRT_{i}_QTY", 0)
-            else:
-                # Ensure deactivated stations are reset/empty
-                await self.update_node(f"SRT_{i}_ITEMNAME", "")
-                await self.update_node(f"SRT_{i}_CUTTING", False)
-                await self.update_node(f"SRT_{i}_TAPE", False)
-                await self.update_node(f"SRT_{i}_VENEER_L", 0.0)
-                await self.update_node(f"SRT_{i}_QTY", 0)
-
+        # Flush in finally so tags staged before a bad station value are still
+        # written now, rather than leaking into the next tick's write
+        try:
+            self.current_order = po_id
+            self._lpn_prefix = f"LPN-{po_id}-BOX"
+            self.order_active = True
+
+            # Reset all box quantities
+            self.box_quantities = array.array("i", [0] * 6)
+        
+            # Update STARTED_PO tags
+            self.update_node("SRT_PO_ID", po_id)
+            self.update_node("SRT_PO_QTY", po_qty)
+            # Update custom attributes from payload
+            self.update_node("SRT_SPEEDBELTTRANSPORT", speedbelt)
+            self.update_node("SRT_MAXSHEETSBOX", max_sheets)
+            self.update_node("SRT_OPENBOXDISTNACE", open_distance)
+            self.update_node("SRT_OBJT_NEW_VALUE", True)
+            self.update_node("ORDER_STATUS", 1)  # 1 = active
+        
+            # Initialize VENEER_STACKED
+            self.update_node("OUT_PO_ID", po_id)
+            self.update_node("OUT_LPN_QTY", 0)
+            self.update_node("OUT_BOXNR", 1)
+            self.update_node("OUT_BOXFULL", False)
+            self.update_node("OUT_PLC_NEW_VALUE", False)
+        
+            # Initialize stations according to payload 'stations' list.
+            # If a station entry is missing or active is False, leave it deactivated and clear values.
+            del self._active_indices[:]
+            for i in range(6):
+                st = stations[i] if len(stations) > i and isinstance(stations[i], dict) else {}
+                active = bool(st.get("active", False))
+
+                if active:
+                    # Set optional station properties when active
+                    itemname = str(st.get(f"box{i + 1}_material") or st.get("material") or "")
+                    cutting = bool(st.get("cutting", False))
+                    tape = bool(st.get("tape", False))
+                    veneer_l = _first_present(st, "veneer_l", default=0.0, cast=float)
+
+                    self.update_station(i, True, itemname, cutting, tape, veneer_l)
+                    self._active_indices.append(i)
+                else:
+                    # Ensure deactivated stations are reset/empty
+                    self.update_station(i, False, "", False, False, 0.0)
+
+        finally:
+            await self.flush_updates()
         logger.info(f"Order {po_id} started - configured stations from payload - simulation running every {SIMULATION_INTERVAL}s")
 
     async def handle_stop_order(self, payload: Dict = None):
@@ -287,35 +491,37 @@ class Sort3Simulator:
         # STOP the simulation
         self.order_active = False
         self.current_order = ""
+        self._lpn_prefix = ""
         
         # Reset box quantities
-        self.box_quantities = {i: 0 for i in range(1, 7)}
-        
-        # Reset STARTED_PO
-        await self.update_node("SRT_OBJT_NEW_VALUE", False)
-        await self.update_node("SRT_PLC_VALUE_PROCESSED", True)
-        await self.update_node("SRT_PO_ID", "")
-        await self.update_node("SRT_PO_QTY", 0)
-        await self.update_node("ORDER_STATUS", 0)  # 0 = stopped
-        
-        # Reset VENEER_STACKED
-        await self.update_node("OUT_PO_ID", "")
-        await self.update_node("OUT_LPN_QTY", 0)
-        await self.update_node("OUT_PLC_NEW_VALUE", False)
-
-        # Reset custom attributes to defaults
-        await self.update_node("SRT_SPEEDBELTTRANSPORT", 0.0)
-        await self.update_node("SRT_MAXSHEETSBOX", 0.0)
-        await self.update_node("SRT_OPENBOXDISTNACE", 0.0)
-        
-        # Deactivate all stations
-        for i in range(1, 7):
-            await self.update_node(f"SRT_{i}_ACTIVE", False)
-            await self.update_node(f"SRT_{i}_ITEMNAME", "")
-            await self.update_node(f"SRT_{i}_CUTTING", False)
-            await self.update_node(f"SRT_{i}_TAPE", False)
-            await self.update_node(f"SRT_{i}_VENEER_L", 0.0)
-            await self.update_node(f"SRT_{i}_QTY", 0)
+        self.box_quantities = array.array("i", [0] * 6)
+        
+        # Flush in finally so a failure part-way does not leave staged resets behind
+        try:
+            # Reset STARTED_PO
+            self.update_node("SRT_OBJT_NEW_VALUE", False)
+            self.update_node("SRT_PLC_VALUE_PROCESSED", True)
+            self.update_node("SRT_PO_ID", "")
+            self.update_node("SRT_PO_QTY", 0)
+            self.update_node("ORDER_STATUS", 0)  # 0 = stopped
+        
+            # Reset VENEER_STACKED
+            self.update_node("OUT_PO_ID", "")
+            self.update_node("OUT_LPN_QTY", 0)
+            self.update_node("OUT_PLC_NEW_VALUE", False)
+
+            # Reset custom attributes to defaults
+            self.update_node("SRT_SPEEDBELTTRANSPORT", 0.0)
+            self.update_node("SRT_MAXSHEETSBOX", 0.0)
+            self.update_node("SRT_OPENBOXDISTNACE", 0.0)
+        
+            # Deactivate all stations
+            del self._active_indices[:]
+            for i in range(6):
+                self.update_station(i, False, "", False, False, 0.0)
+        finally:
+            await self.flush_updates()
+        
         logger.info("=" * 50)
         logger.info("ORDER STOPPED - Simulation paused, all stations deactivated")
         logger.info("=" * 50)
@@ -326,100 +532,123 @@ class Sort3Simulator:
         All 6 boxes are used simultaneously - randomly select one box
         and increment its quantity.
         """
-        import random
-        
         if not self.order_active:
             return
         max_sheets = self.state.get("SRT_MAXSHEETSBOX", 0)
-        po_id = self.state.get("OUT_PO_ID", "")
 
-        # Determine active stations; if none are active, skip this tick
-        active_stations = [i for i in range(1, 7) if bool(self.state.get(f"SRT_{i}_ACTIVE"))]
-        if not active_stations:
+        # If no stations are active, skip this tick
+        active_indices = self._active_indices
+        if not active_indices:
             logger.debug("No active stations configured - skipping simulation tick")
             return
 
         # Randomly select one of the active boxes
-        selected_box = random.choice(active_stations)
+        box_index = active_indices[_rand.randrange(len(active_indices))]
+        selected_box = box_index + 1
         
         # Get and increment the selected box's quantity
-        current_qty = self.box_quantities[selected_box]
+        current_qty = self.box_quantities[box_index]
         new_qty = current_qty + 1
-        self.box_quantities[selected_box] = new_qty
+        self.box_quantities[box_index] = new_qty
         
         # Check if this box is now full
         box_full = max_sheets > 0 and new_qty >= max_sheets
         
         # Generate LPN ID for this box
-        lpn_id = f"LPN-{po_id}-BOX{selected_box:03d}"
+        lpn_id = self._lpn_prefix + _BOX_SUFFIX[box_index]
         
         # Update VENEER_STACKED nodes
-        await self.update_node("OUT_BOXNR", selected_box)
-        await self.update_node("OUT_LPN_QTY", new_qty)
-        await self.update_node("OUT_LPN_ID", lpn_id)
-        await self.update_node("OUT_PLC_NEW_VALUE", True)
-        await self.update_node("OUT_BOXFULL", box_full)
+        state = self.state
+        state["OUT_BOXNR"] = self._write_out_boxnr(selected_box)
+        state["OUT_LPN_QTY"] = self._write_out_lpn_qty(new_qty)
+        state["OUT_LPN_ID"] = self._write_out_lpn_id(lpn_id)
+        state["OUT_PLC_NEW_VALUE"] = self._write_out_plc_new_value(True)
+        state["OUT_BOXFULL"] = self._write_out_boxfull(box_full)
         
         # Update the selected box's quantity tag
-        await self.update_node(f"SRT_{selected_box}_QTY", new_qty)
+        self.update_station_qty(box_index, new_qty)
+        await self.flush_updates()
         
-        # Log with all box quantities
-        qty_summary = ", ".join([f"B{i}:{self.box_quantities[i]}" for i in range(1, 7)])
-        logger.info(f"VENEER STACKED: Box {selected_box} -> Qty={new_qty}, Full={box_full} | All: [{qty_summary}]")
+        # Log with all box quantities (only build the summary if INFO is enabled)
+        if logger.isEnabledFor(logging.INFO):
+            qty_summary = ", ".join([f"B{i}:{qty}" for i, qty in enumerate(self.box_quantities, 1)])
+            logger.info("VENEER STACKED: Box %d -> Qty=%d, Full=%s | All: [%s]", selected_box, new_qty, box_full, qty_summary)
         
-        # Reset PLC_NEW_VALUE after short delay (pulse)
-        await asyncio.sleep(0.5)
-        await self.update_node("OUT_PLC_NEW_VALUE", False)
+        # Reset PLC_NEW_VALUE after short delay (pulse) without holding up the tick
+        self._schedule_pulse_reset(0.5, self.update_node, "OUT_PLC_NEW_VALUE", False)
         
         # If box is full, reset that box's quantity (simulating box replacement)
         if box_full:
-            self.box_quantities[selected_box] = 0
-            await self.update_node(f"SRT_{selected_box}_QTY", 0)
+            self.box_quantities[box_index] = 0
+            self._schedule_pulse_reset(0.5, self.update_station_qty, box_index, 0)
             logger.info(f"Box {selected_box} FULL and replaced - quantity reset to 0")
 
+    def _schedule_pulse_reset(self, delay: float, reset: Callable[..., Any], *args: Any):
+        """Stage reset(*args) after a delay and flush it, in the background."""
+        task = asyncio.create_task(self._pulse_reset(delay, reset, *args))
+        self._pulse_tasks.add(task)
+        task.add_done_callback(self._pulse_tasks.discard)
+
+    async def _pulse_reset(self, delay: float, reset: Callable[..., Any], *args: Any):
+        await asyncio.sleep(delay)
+        reset(*args)
+        await self.flush_updates()
+
     async def mqtt_listener(self):
         """Listen for MQTT messages using aiomqtt."""
-        import aiomqtt
-        
+        backoff = _MQTT_BACKOFF_INITIAL
         while self.running:
             try:
                 logger.info(f"Connecting to MQTT broker at {MQTT_BROKER}:{MQTT_PORT}...")
                 
-                async with aiomqtt.Client(MQTT_BROKER, MQTT_PORT, identifier="sort3-simulator") as client:
+                async with aiomqtt.Client(
+                    MQTT_BROKER,
+                    MQTT_PORT,
+                    identifier="sort3-simulator",
+                    keepalive=MQTT_KEEPALIVE,
+                    socket_options=_MQTT_SOCKET_OPTIONS,
+                ) as client:
                     logger.info("Connected to MQTT broker!")
+                    backoff = _MQTT_BACKOFF_INITIAL
                     
                     # Subscribe to topics
-                    await client.subscribe("menen/sort3/start_order")
-                    await client.subscribe("menen/sort3/stop_order")
-                    logger.info("Subscribed to menen/sort3/start_order and menen/sort3/stop_order")
+                    await client.subscribe(_START_TOPIC)
+                    await client.subscribe(_STOP_TOPIC)
+                    logger.info(f"Subscribed to {_START_TOPIC} and {_STOP_TOPIC}")
                     
                     # Publish that we're ready
-                    await client.publish("menen/sort3/status", json.dumps({"status": "ready"}))
+                    await client.publish("menen/sort3/status", orjson.dumps({"status": "ready"}))
                     
                     async for message in client.messages:
-                        topic = str(message.topic)
+                        # Topic.value is already a str; no str() conversion per message
+                        topic = message.topic.value
                         try:
-                            payload = json.loads(message.payload.decode()) if message.payload else {}
-                        except json.JSONDecodeError:
+                            # orjson parses the payload bytes directly, no intermediate str
+                            payload = orjson.loads(message.payload) if message.payload else {}
+                        except orjson.JSONDecodeError:
                             logger.warning(f"Invalid JSON in message, using raw payload")
-                            payload = {"raw": message.payload.decode()}
+                            payload = {"raw": message.payload.decode(errors="replace")}
                         
                         logger.info(f"MQTT received: {topic} -> {payload}")
                         
                         try:
-                            if topic == "menen/sort3/start_order":
+                            if topic == _START_TOPIC:
                                 await self.handle_start_order(payload)
-                            elif topic == "menen/sort3/stop_order":
+                            elif topic == _STOP_TOPIC:
                                 await self.handle_stop_order(payload)
                         except Exception as e:
                             logger.error(f"Error handling message on {topic}: {e}")
                             
             except aiomqtt.MqttError as e:
-                logger.error(f"MQTT error: {e} - reconnecting in 5s...")
-                await asyncio.sleep(5)
+                delay = backoff + _rand.random()
+                logger.error(f"MQTT error: {e} - reconnecting in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, _MQTT_BACKOFF_MAX)
             except Exception as e:
-                logger.error(f"MQTT listener error: {e} - reconnecting in 5s...")
-                await asyncio.sleep(5)
+                delay = backoff + _rand.random()
+                logger.error(f"MQTT listener error: {e} - reconnecting in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, _MQTT_BACKOFF_MAX)
 
     async def simulation_loop(self):
         """Main simulation loop."""
@@ -448,8 +677,8 @@ class Sort3Simulator:
         logger.info(f"  OPC UA: opc.tcp://localhost:{OPCUA_PORT}")
         logger.info(f"  MQTT: {MQTT_BROKER}:{MQTT_PORT}")
         logger.info("  Topics:")
-        logger.info("    - menen/sort3/start_order")
-        logger.info("    - menen/sort3/stop_order")
+        logger.info(f"    - {_START_TOPIC}")
+        logger.info(f"    - {_STOP_TOPIC}")
         logger.info("=" * 50)
         
         # Wait for tasks
@@ -464,6 +693,9 @@ class Sort3Simulator:
         self.running = False
         self.order_active = False
         
+        for task in list(self._pulse_tasks):
+            task.cancel()
+        
         if self.server:
             await self.server.stop()
         
@@ -487,4 +719,5 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # Run on uvloop's libuv-based event loop instead of the default asyncio loop
+    uvloop.run(main())